@@ -5,57 +5,237 @@ Author: Matrix
 """
 
 import os
+import re
 import sys
+import copy
+import time
+import random
+import queue
+import shutil
+import signal
+import mimetypes
+import secrets
 import argparse
+import threading
+import functools
+import contextvars
 import subprocess
 import asyncio
 import logging
-import requests
-from bs4 import BeautifulSoup
-from logging.handlers import RotatingFileHandler
-from urllib.parse import unquote
+import httpx
+import orjson
+from selectolax.lexbor import LexborHTMLParser
+from logging.handlers import RotatingFileHandler, MemoryHandler, QueueHandler, QueueListener
+from urllib.parse import quote, unquote, urlsplit, urlunsplit, parse_qsl, urlencode, urljoin
 from contextlib import asynccontextmanager
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor
-from fastapi.responses import FileResponse 
 
 import yt_dlp
-from fastapi import FastAPI, Query, HTTPException, Request
-from fastapi.responses import JSONResponse, FileResponse, HTMLResponse
+from cachetools import LRUCache, TTLCache
+from fastapi import FastAPI, Query, HTTPException, Request, Depends, Header
+from fastapi.responses import Response, JSONResponse, FileResponse, HTMLResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
+from starlette.staticfiles import NotModifiedResponse
 
 
 # ---------------------- Configuration ----------------------
 HOST = "144.91.87.159"
 PORT = 25566
+# Fixed public base URL (e.g. "https://dl.example.com") when the proxy in front never changes;
+# otherwise it is detected per request from the forwarded headers.
+PUBLIC_BASE_URL = os.environ.get("PUBLIC_BASE_URL", "").rstrip("/")
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")  # unset disables the admin endpoints
 CACHE_DIR = "cache"
 MAX_CACHE_FILES = 10
-
-DEBUG = False  # set via CLI when running directly
-download_queue = asyncio.Queue()
-executor = ThreadPoolExecutor(max_workers=3) # Increased workers for info fetching
+# In-progress downloads (.part, .part-FragN, .ytdl) are written here and only the finished
+# file is moved into CACHE_DIR, so clean_cache never sees or deletes them. yt-dlp joins the
+# relative outtmpl beneath it (DOWNLOAD_TEMP_DIR/cache/...); absolute so the working
+# directory at download time doesn't matter.
+DOWNLOAD_TEMP_DIR = os.path.abspath(os.environ.get("DOWNLOAD_TEMP_DIR", ".download-tmp"))
+# Leftovers of aborted downloads older than this are pruned; well past the longest download.
+DOWNLOAD_TEMP_MAX_AGE = 6 * 3600
+# yt-dlp's own cache (YouTube player JS and signature functions); kept outside the served CACHE_DIR.
+YTDLP_CACHE_DIR = os.environ.get("YTDLP_CACHE_DIR", ".yt-dlp-cache")
+MEDIA_CHUNK_SIZE = 1 << 20  # bytes per read/send when streaming media files
+CACHE_CLEAN_INTERVAL = 60  # seconds between background cache cleanups
+INFO_CACHE_SIZE = 2000
+INFO_CACHE_TTL = 600  # seconds a yt-dlp info dict is reused before re-extracting
+DOWNLOAD_CACHE_SIZE = 2048
+DOWNLOAD_CACHE_TTL = 900  # seconds a finished download is served again without yt-dlp
+YDL_POOL_SIZE = 4  # YoutubeDL instances kept per worker thread
+SEARCH_CACHE_SIZE = 512
+SEARCH_CACHE_TTL = 120  # search listings change more often than video metadata
+TRACKING_PARAMS = frozenset({"fbclid", "gclid", "igshid", "igsh", "si", "feature", "mibextid"})
+PLAYLIST_TYPES = frozenset({"playlist", "multi_video"})
+SEARCH_CONCURRENCY = 2
+SEARCH_DELAY = (1.0, 3.0)  # random gap in seconds between consecutive scraper requests
+VIDEO_ID_RE = re.compile(r'/video-([a-zA-Z0-9]+)/')
+UNSAFE_FILENAME_CHARS = re.compile(r'[^\w ]+')
+PARTIAL_FILE_RE = re.compile(r'\.(part(-Frag\d+)?|ytdl|temp)(\.|$)')  # yt-dlp in-progress files
+THREAD_POOL_SIZE = int(os.environ.get("THREAD_POOL_SIZE", min(32, (os.cpu_count() or 4) * 4)))
+# DL_WORKERS is the older name for the download pool size.
+MAX_CONCURRENT_DOWNLOADS = int(os.environ.get("MAX_CONCURRENT_DOWNLOADS", os.environ.get("DL_WORKERS", 3)))
+# Parallel fragment requests per HLS/DASH download, and the Range size for single-file ones.
+FRAGMENT_CONCURRENCY = int(os.environ.get("FRAGMENT_CONCURRENCY", 8))
+HTTP_CHUNK_SIZE = 10 << 20
+MAX_CONCURRENT_EXTRACTIONS = int(os.environ.get("MAX_CONCURRENT_EXTRACTIONS", os.cpu_count() or 4))
+MAX_EXTRACTIONS_PER_HOST = int(os.environ.get("MAX_EXTRACTIONS_PER_HOST", 4))
+YTDLP_SOCKET_TIMEOUT = 30  # seconds a yt-dlp socket may sit idle before the read fails
+EXTRACT_TIMEOUT = int(os.environ.get("EXTRACT_TIMEOUT", 120))
+# A host is skipped for a while once more than half its extractions in the window failed.
+BREAKER_WINDOW = 60
+BREAKER_MIN_CALLS = 5
+
+# is_audio -> yt-dlp format for ?stream=true. stdout can only carry one file, so only formats
+# that already contain both video and audio qualify; sites offering separate streams only fail.
+STREAM_FORMATS = {
+    True: "bestaudio/best[acodec!=none]",
+    False: "best[ext=mp4][vcodec!=none][acodec!=none]/best[vcodec!=none][acodec!=none]",
+}
+# is_audio -> (media type, file extension) of the files the download endpoints serve.
+MEDIA_TYPES = {True: ("audio/mpeg", "mp3"), False: ("video/mp4", "mp4")}
+# Routes whose JSON/HTML bodies are worth compressing; everything else serves media files.
+GZIP_PATHS = frozenset({
+    "/", "/info", "/search/xnxx", "/download/facebook", "/download/facebookmp3",
+    "/download/xnxx", "/docs", "/openapi.json",
+})
+# Download endpoints stream finished cache files, so clients may reuse them for an hour.
+DOWNLOAD_HEADERS = {"Cache-Control": "public, max-age=3600"}
+# e.g. "/_protected/" when nginx maps that internal location to CACHE_DIR
+ACCEL_REDIRECT_PREFIX = os.environ.get("ACCEL_REDIRECT_PREFIX")
+
+COOKIES_PATH = "cookies.txt"
+
+
+def cookies_state():
+    """(path, mtime_ns) of cookies.txt, or (None, None) when there is no cookie file."""
+    try:
+        return COOKIES_PATH, os.stat(COOKIES_PATH).st_mtime_ns
+    except OSError:
+        return None, None
+
+
+# Refreshed by periodic_clean; the mtime is part of every pooled YoutubeDL key.
+COOKIES_FILE, COOKIES_MTIME = cookies_state()
+
+DEBUG = os.environ.get("DEBUG") == "1"  # set via CLI when running directly
+# Per-request debug flag; asyncio.to_thread copies the context into the worker thread.
+DEBUG_CTX = contextvars.ContextVar("debug", default=DEBUG)
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", 1))
+# Workers don't see each other's single_flight maps, so each keeps its partial downloads apart.
+WORKER_TEMP_DIR = os.path.join(DOWNLOAD_TEMP_DIR, str(os.getpid())) if WEB_CONCURRENCY > 1 else DOWNLOAD_TEMP_DIR
+# Installed as the loop's default executor, so asyncio.to_thread calls (info, cleanup) share it.
+executor = ThreadPoolExecutor(max_workers=THREAD_POOL_SIZE, thread_name_prefix="worker")
+# Downloads are bound by bandwidth and disk, so they get their own small pool and never
+# hold up the quick metadata work on the default executor.
+download_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_DOWNLOADS, thread_name_prefix="download")
+# yt-dlp extraction is partly CPU-bound (page parsing, JS challenges), so cap it near the core count.
+info_semaphore = asyncio.Semaphore(MAX_CONCURRENT_EXTRACTIONS)
+# ...and cap each site separately, so one slow host cannot hold every extraction slot.
+host_semaphores = LRUCache(maxsize=256)
+# ?stream=true runs yt-dlp (and ffmpeg) subprocesses; cap them like cached downloads.
+stream_semaphore = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+
+# Enhanced headers to look like a real browser
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
+    'Accept-Language': 'en-US,en;q=0.9',
+    'Accept-Encoding': 'gzip, deflate, br',
+    'DNT': '1',
+    'Upgrade-Insecure-Requests': '1',
+    'Sec-Fetch-Dest': 'document',
+    'Sec-Fetch-Mode': 'navigate',
+    'Sec-Fetch-Site': 'none',
+    'Cache-Control': 'max-age=0',
+}
+# One pooled client for all scraping so TCP/TLS connections are kept alive between searches.
+http_client = httpx.AsyncClient(
+    http2=True,
+    headers=HEADERS,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+    timeout=30.0,
+    follow_redirects=True,
+)
+info_cache = TTLCache(maxsize=INFO_CACHE_SIZE, ttl=INFO_CACHE_TTL)
+info_inflight = {}
+search_cache = TTLCache(maxsize=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL)
+search_inflight = {}
+download_cache = TTLCache(maxsize=DOWNLOAD_CACHE_SIZE, ttl=DOWNLOAD_CACHE_TTL)
+download_inflight = {}
 
 # ---------------------- Logging ----------------------
 for handler in logging.root.handlers[:]:
     logging.root.removeHandler(handler)
 
-LOG_FILE = "logs.txt"
+# An empty LOG_FILE logs to stdout only.
+LOG_FILE = os.environ.get("LOG_FILE", "logs.txt")
+if WEB_CONCURRENCY > 1 and LOG_FILE:
+    # Every worker would rotate the same file and clobber the others' backups.
+    sys.exit(f"WEB_CONCURRENCY={WEB_CONCURRENCY} needs file logging off: set LOG_FILE= (empty) to log to stdout only.")
 LOG_FORMAT = "%(asctime)s [%(levelname)s] %(message)s"
 
 log_formatter = logging.Formatter(LOG_FORMAT)
 
-file_handler = RotatingFileHandler(LOG_FILE, maxBytes=5 * 1024 * 1024, backupCount=5)
-file_handler.setFormatter(log_formatter)
-file_handler.setLevel(logging.DEBUG)
+
+class CachedRotatingFileHandler(RotatingFileHandler):
+    """
+    RotatingFileHandler that re-checks whether the log path is a regular file at most
+    once every ISFILE_CHECK_INTERVAL seconds instead of stat-ing it on every emit.
+    """
+    ISFILE_CHECK_INTERVAL = 5.0
+
+    _isfile = True
+    _isfile_checked_at = 0.0
+
+    def shouldRollover(self, record):
+        now = time.monotonic()
+        if now - self._isfile_checked_at >= self.ISFILE_CHECK_INTERVAL:
+            self._isfile = not os.path.exists(self.baseFilename) or os.path.isfile(self.baseFilename)
+            self._isfile_checked_at = now
+        # Never rollover anything other than regular files (bpo-45401)
+        if not self._isfile:
+            return False
+        if self.stream is None:
+            self.stream = self._open()
+        if self.maxBytes > 0:
+            pos = self.stream.tell()
+            if not pos:
+                # gh-116263: Never rollover an empty file
+                return False
+            msg = "%s\n" % self.format(record)
+            if pos + len(msg) >= self.maxBytes:
+                return True
+        return False
+
 
 console_handler = logging.StreamHandler(sys.stdout)
 console_handler.setFormatter(log_formatter)
 console_handler.setLevel(logging.INFO)
 
+# yt-dlp debug output is thousands of records per download; write logs.txt in batches.
+# Warnings and errors flush at once, the rest at least every CACHE_CLEAN_INTERVAL.
+if LOG_FILE:
+    file_handler = CachedRotatingFileHandler(LOG_FILE, maxBytes=5 * 1024 * 1024, backupCount=5)
+    file_handler.setFormatter(log_formatter)
+    file_handler.setLevel(logging.DEBUG)
+    file_buffer = MemoryHandler(capacity=512, flushLevel=logging.WARNING, target=file_handler, flushOnClose=True)
+else:
+    # Keeps the file_buffer.flush() calls below valid.
+    file_buffer = logging.NullHandler()
+
+# Handlers run on a background listener thread so request/worker threads only pay a queue put.
+log_queue = queue.SimpleQueue()
+log_listener = QueueListener(log_queue, file_buffer, console_handler, respect_handler_level=True)
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
-logger.addHandler(file_handler)
-logger.addHandler(console_handler)
+logger.addHandler(QueueHandler(log_queue))
+log_listener.start()
 
 
 class YTDLPLogger:
@@ -65,18 +245,114 @@ class YTDLPLogger:
     def error(self, msg): logger.error(msg)
 
 
+ytdlp_logger = YTDLPLogger()
+
+
+class YDLCache(LRUCache):
+    """LRU of YoutubeDL instances that closes the ones it evicts."""
+    def popitem(self):
+        key, ydl = super().popitem()
+        # close() would save this instance's cookie jar over cookies.txt, which may have
+        # been replaced since; the file belongs to the operator, so never write it back.
+        ydl.params["cookiefile"] = None
+        ydl.close()
+        return key, ydl
+
+
+ydl_local = threading.local()
+ydl_pools = []  # every thread's pool, so lifespan can close them all at shutdown
+
+
+def get_ydl(key: tuple, ydl_opts: dict) -> yt_dlp.YoutubeDL:
+    """
+    Returns a YoutubeDL for `key`, built from ydl_opts only the first time. YoutubeDL
+    is not thread-safe, so each worker thread keeps its own small pool of instances.
+    """
+    pool = getattr(ydl_local, "pool", None)
+    if pool is None:
+        pool = ydl_local.pool = YDLCache(maxsize=YDL_POOL_SIZE)
+        ydl_pools.append(pool)
+    ydl = pool.get(key)
+    if ydl is None:
+        ydl = pool[key] = yt_dlp.YoutubeDL(ydl_opts)
+    return ydl
+
+
+def close_ydl_pools():
+    """Closes every pooled YoutubeDL instance (their HTTP connections and file handles)."""
+    for pool in ydl_pools:
+        while pool:
+            pool.popitem()
+
+
+PROGRESS_LOG_INTERVAL = 1.0  # seconds between progress lines per download thread
+_progress_state = threading.local()
+
+
+def _should_log_progress() -> bool:
+    now = time.monotonic()
+    if now - getattr(_progress_state, "last_log", 0.0) < PROGRESS_LOG_INTERVAL:
+        return False
+    _progress_state.last_log = now
+    return True
+
+
+def log_progress(d):
+    """yt-dlp progress hook (debug only): logs a short summary at most once per second."""
+    if d.get("status") == "finished" or _should_log_progress():
+        # Lazy %-args: nothing is formatted unless the record is actually emitted.
+        logger.debug(
+            "Download %s: %s %s ETA %s",
+            d.get("status"),
+            d.get("filename"),
+            (d.get("_percent_str") or "").strip(),
+            (d.get("_eta_str") or "").strip(),
+        )
+
+
 # ---------------------- FastAPI Setup ----------------------
+class ORJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson: faster than json.dumps and straight to bytes."""
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     logger.info("========== YT-DOWNLOADER STARTED ==========")
-    asyncio.create_task(process_queue())
+    asyncio.get_running_loop().set_default_executor(executor)
+    cleaner = asyncio.create_task(periodic_clean())
     yield
     logger.info("========== YT-DOWNLOADER SHUTTING DOWN ==========")
+    cleaner.cancel()
+    await http_client.aclose()
+    close_ydl_pools()
+    log_listener.stop()
+    file_buffer.flush()
+
+
+app = FastAPI(
+    title="Universal Media Downloader API Backend Developed by Matrix-King",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
 
 
-app = FastAPI(title="Universal Media Downloader API Backend Developed by Matrix-King", lifespan=lifespan)
+class APIGZipMiddleware(GZipMiddleware):
+    """
+    GZip for the JSON/HTML routes only. Media files are already compressed, and gzipping
+    them would drop Content-Length and break Range requests for players and resumes.
+    """
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] not in GZIP_PATHS:
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
 
 
+app.add_middleware(APIGZipMiddleware, minimum_size=1024)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -85,8 +361,197 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+
+class MediaFileResponse(FileResponse):
+    """FileResponse that reads media in MEDIA_CHUNK_SIZE blocks instead of Starlette's 64 KiB."""
+    chunk_size = MEDIA_CHUNK_SIZE
+
+
+def media_response(filepath: str, stat_result, media_type: str, filename: str):
+    """
+    Response for a finished download. With ACCEL_REDIRECT_PREFIX set (nginx in front,
+    CACHE_DIR exposed as an internal location), nginx sends the file itself via sendfile.
+    """
+    response = MediaFileResponse(
+        path=filepath,
+        stat_result=stat_result,
+        headers=DOWNLOAD_HEADERS,
+        media_type=media_type,
+        filename=filename
+    )
+    if not ACCEL_REDIRECT_PREFIX:
+        return response
+    return Response(media_type=media_type, headers={
+        "X-Accel-Redirect": ACCEL_REDIRECT_PREFIX + quote(os.path.basename(filepath)),
+        "Content-Disposition": response.headers["content-disposition"],
+        **DOWNLOAD_HEADERS,
+    })
+
+
+class MediaPipe:
+    """
+    yt-dlp writing a single-file format to stdout, piped through ffmpeg for mp3. Only
+    formats that already carry both video and audio can go to stdout (nothing is merged),
+    and the stderr of both processes is forwarded to the log. yt-dlp reads the already
+    extracted info from stdin, so it starts downloading without extracting again.
+    """
+    def __init__(self, url: str, info: dict, format_id: str, is_audio: bool):
+        self.url = url
+        self.info = info
+        self.format_id = format_id
+        self.is_audio = is_audio
+        self.procs = []
+        self.stderr_tasks = []
+        self.errors = []
+
+    async def start(self):
+        # On expired format URLs yt-dlp falls back to extracting webpage_url itself.
+        cmd = [sys.executable, "-m", "yt_dlp", "--quiet", "--no-warnings", "--no-playlist",
+               "--socket-timeout", str(YTDLP_SOCKET_TIMEOUT), "--cache-dir", YTDLP_CACHE_DIR,
+               "-f", self.format_id, "-o", "-", "--load-info-json", "-"]
+        if COOKIES_FILE:
+            cmd += ["--cookies", COOKIES_FILE]
+
+        if self.is_audio:
+            read_fd, write_fd = os.pipe()
+            try:
+                ytdlp = await self._spawn("yt-dlp", cmd, stdin=subprocess.PIPE, stdout=write_fd)
+                await self._spawn("ffmpeg", [
+                    "ffmpeg", "-loglevel", "error", "-i", "pipe:0", "-vn", "-b:a", "320k", "-f", "mp3", "pipe:1",
+                ], stdin=read_fd, stdout=subprocess.PIPE)
+            finally:
+                os.close(write_fd)
+                os.close(read_fd)
+        else:
+            ytdlp = await self._spawn("yt-dlp", cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        ytdlp.stdin.write(orjson.dumps(self.info))
+        try:
+            await ytdlp.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # yt-dlp already exited; its stderr says why
+        ytdlp.stdin.close()
+
+    async def _spawn(self, name: str, cmd: list, **kwargs):
+        proc = await asyncio.create_subprocess_exec(*cmd, stderr=subprocess.PIPE, **kwargs)
+        self.procs.append(proc)
+        self.stderr_tasks.append(asyncio.create_task(self._log_stderr(name, proc)))
+        return proc
+
+    async def _log_stderr(self, name: str, proc):
+        async for line in proc.stderr:
+            line = line.decode(errors="replace").strip()
+            if line:
+                self.errors.append(line)
+                logger.warning(f"{name} stream for {self.url}: {line}")
+
+    async def read(self) -> bytes:
+        return await self.procs[-1].stdout.read(MEDIA_CHUNK_SIZE)
+
+    async def close(self, kill: bool):
+        """Waits for (or, if the client went away, kills) both processes and their stderr readers."""
+        for proc in self.procs:
+            if kill and proc.returncode is None:
+                proc.kill()
+            await proc.wait()
+        await asyncio.gather(*self.stderr_tasks, return_exceptions=True)
+
+    @property
+    def failed(self) -> bool:
+        return any(proc.returncode for proc in self.procs)
+
+
+async def stream_media(url: str, info: dict, format_id: str, is_audio: bool):
+    """
+    Yields the media bytes from a MediaPipe. The first item is always None: it is produced
+    only once output has actually started, so stream_response can fail with a proper status
+    instead of sending a 200 for an empty file.
+    """
+    async with stream_semaphore:
+        pipe = MediaPipe(url, info, format_id, is_audio)
+        completed = False
+        try:
+            try:
+                await pipe.start()
+            except OSError as e:
+                logger.error(f"Could not start stream for {url}: {e}")
+                raise HTTPException(status_code=502, detail=f"Could not start the stream: {e}") from None
+            chunk = await pipe.read()
+            if not chunk:
+                await pipe.close(kill=False)
+                reason = pipe.errors[-1] if pipe.errors else "no output"
+                logger.error(f"Stream for {url} produced no data: {reason}")
+                raise HTTPException(status_code=502, detail=f"Could not stream this media: {reason}")
+            yield None
+            while chunk:
+                yield chunk
+                chunk = await pipe.read()
+            completed = True
+        finally:
+            # Client gone or stream done: make sure neither process outlives the response.
+            await pipe.close(kill=not completed)
+        if pipe.failed:
+            logger.error(f"Stream for {url} ended with an error; the client got a truncated file")
+
+
+def select_stream_format(info: dict, is_audio: bool) -> dict:
+    """The format STREAM_FORMATS picks from an info dict, resolved without downloading."""
+    ydl = get_ydl(("stream", is_audio), {
+        "format": STREAM_FORMATS[is_audio],
+        "simulate": True,
+        "logger": ytdlp_logger,
+        "quiet": True,
+    })
+    return ydl.process_ie_result(copy.deepcopy(info), download=False)
+
+
+async def stream_response(url: str, is_audio: bool, default: str):
+    """
+    StreamingResponse for stream_media. The info comes from get_cached_info, so streams share
+    /info's cache and circuit breaker, and the format is chosen up front to label the response.
+    """
+    try:
+        info = await get_cached_info(url)
+        if info.get("_type", "video") != "video":
+            raise ValueError("the URL is not a single video")
+        selected = await asyncio.to_thread(select_stream_format, info, is_audio)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Could not pick a stream format for {url}: {e}")
+        raise HTTPException(status_code=502, detail=f"Could not stream this media: {e}") from None
+    chunks = stream_media(url, info, selected["format_id"], is_audio)
+    await anext(chunks)  # waits for the first bytes, or raises if yt-dlp failed
+    if is_audio:
+        media_type, extension = MEDIA_TYPES[True]  # ffmpeg always outputs mp3
+    else:
+        extension = selected.get("ext") or "mp4"
+        media_type = mimetypes.guess_type(f"media.{extension}")[0] or "application/octet-stream"
+    filename = safe_name(info.get("title"), extension, default)
+    return StreamingResponse(
+        chunks,
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename*=utf-8''{quote(filename)}"},
+    )
+
+
+class CacheStaticFiles(StaticFiles):
+    """
+    StaticFiles for the download cache. A cached file never changes for a given
+    video_id.ext, so clients and CDNs may keep it for a year and revalidate by ETag.
+    Range requests (player seeks, resumed downloads) are answered by FileResponse with 206.
+    """
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        response = MediaFileResponse(full_path, status_code=status_code, stat_result=stat_result)
+        response.headers["etag"] = f'"{stat_result.st_size:x}-{int(stat_result.st_mtime):x}"'
+        response.headers["cache-control"] = "public, max-age=31536000, immutable"
+        if self.is_not_modified(response.headers, Headers(scope=scope)):
+            return NotModifiedResponse(response.headers)
+        return response
+
+
 os.makedirs(CACHE_DIR, exist_ok=True)
-app.mount("/cache", StaticFiles(directory=CACHE_DIR), name="cache")
+# CacheStaticFiles serves /cache/* directly; there is no separate route for it.
+app.mount("/cache", CacheStaticFiles(directory=CACHE_DIR), name="cache")
 
 
 
@@ -95,52 +560,296 @@ def create_response(success: bool, result=None, message=None, status=200):
     response = {"creator": "Matrix - King", "status": status, "success": success, "result": result}
     if message:
         response["message"] = message
-    return JSONResponse(status_code=status, content=response)
+    return ORJSONResponse(status_code=status, content=response)
 
 
 def clean_cache():
-    files = sorted(
-        [os.path.join(CACHE_DIR, f)
-         for f in os.listdir(CACHE_DIR)
-         if os.path.isfile(os.path.join(CACHE_DIR, f))],
-        key=os.path.getmtime,
-    )
-    while len(files) > MAX_CACHE_FILES:
+    # scandir hands back DirEntry objects whose stat results are cached per entry.
+    with os.scandir(CACHE_DIR) as it:
+        entries = [
+            (entry.stat().st_mtime, entry.path) for entry in it
+            if entry.is_file() and not PARTIAL_FILE_RE.search(entry.name)
+        ]
+    if len(entries) <= MAX_CACHE_FILES:
+        return
+    entries.sort()
+    # Oldest first: drop everything beyond the newest MAX_CACHE_FILES.
+    for _, path in entries[:max(0, len(entries) - MAX_CACHE_FILES)]:
         try:
-            os.remove(files.pop(0))
-        except Exception as e:
+            os.remove(path)
+        except OSError as e:
             logger.warning(f"Failed to remove cache file: {e}")
 
 
+def clean_download_temp():
+    """Removes partial files (and then empty directories) that aborted downloads left in DOWNLOAD_TEMP_DIR."""
+    cutoff = time.time() - DOWNLOAD_TEMP_MAX_AGE
+    for root, dirs, files in os.walk(DOWNLOAD_TEMP_DIR, topdown=False):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                if os.stat(path).st_mtime < cutoff:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"Failed to remove stale download file: {e}")
+        if root != DOWNLOAD_TEMP_DIR:
+            try:
+                # Only succeeds once empty; a directory yt-dlp is writing into again is left alone.
+                if os.stat(root).st_mtime < cutoff:
+                    os.rmdir(root)
+            except OSError:
+                pass
+
+
+def refresh_cookies_file():
+    global COOKIES_FILE, COOKIES_MTIME
+    COOKIES_FILE, COOKIES_MTIME = cookies_state()
+
+
+async def periodic_clean():
+    """
+    Trims the cache directory every CACHE_CLEAN_INTERVAL seconds on the executor, prunes
+    stale partial downloads, re-stats cookies.txt, so requests never stat it themselves and
+    a replaced file gets fresh YoutubeDL instances, and writes out buffered log records.
+    """
+    while True:
+        try:
+            await asyncio.to_thread(clean_cache)
+            await asyncio.to_thread(clean_download_temp)
+            await asyncio.to_thread(refresh_cookies_file)
+            await asyncio.to_thread(file_buffer.flush)
+        except Exception as e:
+            logger.warning(f"Cache cleanup failed: {e}")
+        await asyncio.sleep(CACHE_CLEAN_INTERVAL)
+
+
+async def public_url(request: Request) -> str:
+    """
+    Dependency that detects the public base URL (your worker URL) from proxy headers,
+    unless PUBLIC_BASE_URL pins it. Computed once per request and kept on request.state.
+    Async so FastAPI runs it inline instead of on the shared threadpool.
+    """
+    if PUBLIC_BASE_URL:
+        return PUBLIC_BASE_URL
+    if not hasattr(request.state, "public_url"):
+        host = request.headers.get('x-forwarded-host') or request.headers.get('host', f"{HOST}:{PORT}")
+        scheme = request.headers.get('x-forwarded-proto', 'http')
+        request.state.public_url = f"{scheme}://{host}"
+    return request.state.public_url
+
+
+async def decoded_url(url: str = Query(..., description="The media URL, optionally URL-encoded.")) -> str:
+    """Dependency that percent-decodes the url query parameter once for the whole request."""
+    return unquote(url)
+
+
+def stat_file(filepath):
+    """Returns os.stat_result for a file (handed to FileResponse), or None if it is missing."""
+    try:
+        return os.stat(filepath) if filepath else None
+    except FileNotFoundError:
+        return None
+
+
+@functools.lru_cache(maxsize=4096)
+def safe_name(title: str, ext: str, default: str) -> str:
+    """Download filename from a media title: letters, digits, spaces and underscores, max 50 chars."""
+    name = UNSAFE_FILENAME_CHARS.sub('', title or default).rstrip()[:50]
+    return f"{name or default}.{ext}"
+
+
 def get_cache_path(video_id: str, ext: str) -> str:
     return os.path.join(CACHE_DIR, f"{video_id}.{ext}")
 
 
-def search_xnxx_videos(query: str, page: int = 1):
+def normalize_url(url: str) -> str:
+    """Builds the info cache key: trimmed, lower-cased host and no tracking params."""
+    parts = urlsplit(url.strip())
+    query = [
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if not k.lower().startswith("utm_") and k.lower() not in TRACKING_PARAMS
+    ]
+    # Only the scheme and host are case-insensitive; video ids in the path/query are not.
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, urlencode(query), ""))
+
+
+async def single_flight(inflight: dict, key, factory):
+    """
+    Runs factory() once per key: concurrent callers with the same key await the same task.
+    The task is shielded so one client disconnecting does not cancel it for the others.
+    """
+    task = inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(factory())
+        inflight[key] = task
+        task.add_done_callback(lambda _: inflight.pop(key, None))
+    return await asyncio.shield(task)
+
+
+class CircuitBreaker:
+    """
+    Per-host failure tracker. Keeps the outcomes of the last `window` seconds and opens
+    (rejects calls) while at least `min_calls` of them exist and more than half failed.
+    """
+    def __init__(self, window: float, min_calls: int):
+        self.window = window
+        self.min_calls = min_calls
+        self.calls = LRUCache(maxsize=256)  # host -> deque of (monotonic time, ok)
+
+    def _recent(self, host: str):
+        calls = self.calls.get(host)
+        if calls is None:
+            calls = self.calls[host] = deque()
+        cutoff = time.monotonic() - self.window
+        while calls and calls[0][0] < cutoff:
+            calls.popleft()
+        return calls
+
+    def allow(self, host: str) -> bool:
+        calls = self._recent(host)
+        if len(calls) < self.min_calls:
+            return True
+        failures = sum(1 for _, ok in calls if not ok)
+        return failures * 2 <= len(calls)
+
+    def record(self, host: str, ok: bool):
+        self._recent(host).append((time.monotonic(), ok))
+
+
+extract_breaker = CircuitBreaker(BREAKER_WINDOW, BREAKER_MIN_CALLS)
+
+
+def error_chain(e: BaseException):
+    """Yields e and the errors it wraps: DownloadError.exc_info, ExtractorError.cause, __cause__."""
+    seen = set()
+    while isinstance(e, BaseException) and id(e) not in seen:
+        seen.add(id(e))
+        yield e
+        if isinstance(e, yt_dlp.utils.DownloadError):
+            e = e.exc_info[1] if e.exc_info else None
+        elif isinstance(e, yt_dlp.utils.ExtractorError):
+            e = e.cause or (e.exc_info[1] if e.exc_info else None)
+        else:
+            e = e.__cause__ or e.__context__
+
+
+def is_upstream_failure(e: Exception) -> bool:
+    """
+    Whether an extraction error says something about the site (network, HTTP errors, a
+    broken extractor) rather than about the link itself. Unsupported URLs, geo blocks and
+    private or removed videos are the user's problem and must not trip the breaker.
+    """
+    errors = list(error_chain(e))
+    # yt-dlp marks errors raised while handling a network error as expected, so look at the
+    # network error itself: 5xx and 429 mean the site is struggling, 404/403 are about the link.
+    for error in errors:
+        if isinstance(error, yt_dlp.networking.exceptions.HTTPError):
+            return error.status >= 500 or error.status == 429
+        if isinstance(error, yt_dlp.networking.exceptions.TransportError):
+            return True
+    # Judge the error a DownloadError wraps; a bare one carries nothing to go on.
+    e = next((error for error in errors if not isinstance(error, yt_dlp.utils.DownloadError)), None)
+    if e is None:
+        return False
+    if isinstance(e, (yt_dlp.utils.UnsupportedError, yt_dlp.utils.GeoRestrictedError)):
+        return False
+    if isinstance(e, yt_dlp.utils.ExtractorError):
+        # yt-dlp marks "video unavailable", private, login-required etc. as expected errors.
+        return not e.expected
+    return True
+
+
+def host_semaphore(url: str) -> asyncio.Semaphore:
+    """Per-hostname extraction semaphore, created on first use."""
+    host = urlsplit(url).hostname or ""
+    semaphore = host_semaphores.get(host)
+    if semaphore is None:
+        semaphore = host_semaphores[host] = asyncio.Semaphore(MAX_EXTRACTIONS_PER_HOST)
+    return semaphore
+
+
+async def get_cached_info(url: str):
+    """
+    Returns the raw yt-dlp info dict for a URL, extracting it at most once per TTL.
+    Concurrent callers for the same URL share a single extraction.
+    """
+    key = normalize_url(url)
+    info = info_cache.get(key)
+    if info is not None:
+        return info
+
+    async def fetch():
+        host = urlsplit(key).hostname or ""
+        if not extract_breaker.allow(host):
+            raise HTTPException(status_code=503, detail=f"{host} is failing right now, try again shortly.")
+
+        # Wait for the host slot first, so callers queued on a slow site do not hold global slots.
+        host_slot = host_semaphore(key)
+        await host_slot.acquire()
+        try:
+            await info_semaphore.acquire()
+        except BaseException:
+            host_slot.release()
+            raise
+        # A worker thread cannot be stopped, so both slots are released only when it really
+        # returns, even if the request gave up on it; hung extractions stay within the limits.
+        extraction = asyncio.ensure_future(asyncio.to_thread(extract_media_info, url))
+        extraction.add_done_callback(lambda _: (info_semaphore.release(), host_slot.release()))
+
+        try:
+            info = await asyncio.wait_for(asyncio.shield(extraction), EXTRACT_TIMEOUT)
+        except asyncio.TimeoutError:
+            # Retrieve the late result or error so asyncio does not warn about it.
+            extraction.add_done_callback(lambda t: t.cancelled() or t.exception())
+            extract_breaker.record(host, False)
+            raise HTTPException(status_code=504, detail=f"Timed out extracting info from {host}.") from None
+        except Exception as e:
+            if is_upstream_failure(e):
+                extract_breaker.record(host, False)
+            raise
+        extract_breaker.record(host, True)
+        info_cache[key] = info
+        return info
+
+    return await single_flight(info_inflight, key, fetch)
+
+
+class RateLimiter:
+    """
+    Async politeness limiter: at most `concurrency` requests in flight, and each one
+    starts a random `delay` gap after the previous one. Waiting never holds a thread.
+    """
+    def __init__(self, concurrency: int, delay: tuple):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.delay = delay
+        self.next_at = 0.0
+
+    async def __aenter__(self):
+        await self.semaphore.acquire()
+        now = time.monotonic()
+        wait = self.next_at - now
+        self.next_at = max(now, self.next_at) + random.uniform(*self.delay)
+        if wait > 0:
+            try:
+                await asyncio.sleep(wait)
+            except BaseException:
+                self.semaphore.release()
+                raise
+
+    async def __aexit__(self, *exc):
+        self.semaphore.release()
+
+
+search_limiter = RateLimiter(SEARCH_CONCURRENCY, SEARCH_DELAY)
+
+
+async def search_xnxx_videos(query: str, page: int = 1):
     """
     Searches XNXX for a keyword on a specific page and returns a list of results,
     plus a flag indicating if there are more pages, and the next page URL.
     """
-    import re
-    import time
-    import random
-    from urllib.parse import quote
-
-    # Enhanced headers to look like a real browser
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
-        'Accept-Language': 'en-US,en;q=0.9',
-        'Accept-Encoding': 'gzip, deflate, br',
-        'DNT': '1',
-        'Connection': 'keep-alive',
-        'Upgrade-Insecure-Requests': '1',
-        'Sec-Fetch-Dest': 'document',
-        'Sec-Fetch-Mode': 'navigate',
-        'Sec-Fetch-Site': 'none',
-        'Cache-Control': 'max-age=0',
-    }
-
     # Use the correct URL format
     if page > 1:
         search_url = f"https://www.xnxx.com/search/{quote(query)}/{page}"
@@ -148,23 +857,19 @@ def search_xnxx_videos(query: str, page: int = 1):
         search_url = f"https://www.xnxx.com/search/{quote(query)}"
 
     try:
-        session = requests.Session()
-        session.headers.update(headers)
-
-        # Add random delay to look more human
-        time.sleep(random.uniform(1.0, 3.0))
-
-        response = session.get(search_url, timeout=30)
+        # Space requests out with a random delay to look more human
+        async with search_limiter:
+            response = await http_client.get(search_url)
         response.raise_for_status()
 
         # Check if we got redirected (sign of bot detection)
-        if 'search' not in response.url.lower():
+        if 'search' not in str(response.url).lower():
             logger.warning(f"Possible redirect detected. Response URL: {response.url}")
 
-        soup = BeautifulSoup(response.text, 'html.parser')
+        tree = LexborHTMLParser(response.text)
 
         # Look for actual video results
-        video_blocks = soup.select('div.thumb-block')
+        video_blocks = tree.css('div.thumb-block')
 
         logger.info(f"Found {len(video_blocks)} video blocks for query '{query}' on page {page}.")
 
@@ -172,13 +877,13 @@ def search_xnxx_videos(query: str, page: int = 1):
         seen_ids = set()
 
         for block in video_blocks:
-            title_tag = block.select_one('div.thumb-under p a')
+            title_tag = block.css_first('div.thumb-under p a')
             if not title_tag:
                 continue
 
-            href = title_tag.get('href', '')
+            href = title_tag.attributes.get('href') or ''
 
-            match = re.search(r'/video-([a-zA-Z0-9]+)/', href)
+            match = VIDEO_ID_RE.search(href)
             if not match:
                 continue
 
@@ -189,7 +894,7 @@ def search_xnxx_videos(query: str, page: int = 1):
             seen_ids.add(video_id)
 
             page_url = "https://www.xnxx.com" + href
-            title = title_tag.get('title', 'No Title')
+            title = title_tag.attributes.get('title', 'No Title')
 
             results.append({
                 "title": title,
@@ -197,12 +902,12 @@ def search_xnxx_videos(query: str, page: int = 1):
             })
 
         # --- UPDATED PAGINATION DETECTION ---
-        next_page_button = soup.select_one('.pagination ul li a.no-page.next')
+        next_page_button = tree.css_first('.pagination ul li a.no-page.next')
         has_more = next_page_button is not None
 
         next_page_url = None
         if next_page_button:
-            next_page_url = requests.compat.urljoin(search_url, next_page_button.get('href'))
+            next_page_url = urljoin(search_url, next_page_button.attributes.get('href'))
 
         logger.info(f"Successfully scraped {len(results)} results for '{query}' on page {page}. Has more pages: {has_more}")
 
@@ -213,15 +918,26 @@ def search_xnxx_videos(query: str, page: int = 1):
         return {"error": f"The search operation failed: {str(e)}"}
 
 
+async def get_cached_search(query: str, page: int = 1):
+    """Search results for (query, page), scraped at most once per SEARCH_CACHE_TTL."""
+    key = (query.strip().lower(), page)
+    results = search_cache.get(key)
+    if results is not None:
+        return results
+
+    async def fetch():
+        results = await search_xnxx_videos(query, page)
+        if "error" not in results:
+            search_cache[key] = results
+        return results
+
+    return await single_flight(search_inflight, key, fetch)
+
+
 @app.get("/search/xnxx", summary="Search XNXX by keyword with pagination")
 async def search_xnxx_endpoint(query: str = Query(..., description="The keyword to search for."), page: int = Query(1, description="The page number to search.")):
     try:
-        search_results = await asyncio.get_event_loop().run_in_executor(
-            executor, 
-            search_xnxx_videos, 
-            query,
-            page
-        )
+        search_results = await get_cached_search(query, page)
         
         if isinstance(search_results, dict) and "error" in search_results:
              return create_response(False, message=search_results["error"], status=500)
@@ -232,83 +948,131 @@ async def search_xnxx_endpoint(query: str = Query(..., description="The keyword
         return create_response(False, message=str(e), status=500)
 
 
-def get_universal_media_info(url: str, debug: bool = False):
+def extract_media_info(url: str):
     """
-    Universal media info extractor that gets all available formats with their real format_id.
+    Runs a full yt-dlp extraction for a URL and returns the raw info dict.
     """
+    debug = DEBUG_CTX.get()
     logger.info(f"Attempting to get info for '{url}' using cookies.txt")
 
-    ydl_opts = {
+    ydl = get_ydl(("info", debug, COOKIES_FILE, COOKIES_MTIME), {
         "noplaylist": True,
-        "cookiefile": "cookies.txt" if os.path.exists("cookies.txt") else None,
-        "logger": YTDLPLogger(),
+        "cookiefile": COOKIES_FILE,
+        "cachedir": YTDLP_CACHE_DIR,
+        "socket_timeout": YTDLP_SOCKET_TIMEOUT,
+        "logger": ytdlp_logger,
         "quiet": not debug,
         "verbose": debug,
-    }
+    })
+    info = ydl.extract_info(url, download=False)
+    logger.info(f"SUCCESS! Got info for '{url}'.")
+    # Drop what the default format selection left behind (requested_formats/_downloads,
+    # filenames), as --load-info-json does, so a later download can select any format_id.
+    return ydl.sanitize_info(info, remove_private_keys=True)
 
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(url, download=False)
-        
-        processed_formats = []
-        # Loop through all available formats from yt-dlp
-        for f in info.get('formats', []):
-            filesize = f.get('filesize') or f.get('filesize_approx')
-            
-            if not filesize:
-                duration = info.get('duration')
-                tbr = f.get('tbr')
-                if duration and tbr:
-                    filesize = int((tbr * 1000 / 8) * duration)
-
-            # Add every available video format to the list
-            if f.get('vcodec') != 'none':
-                processed_formats.append({
-                    "quality": f.get('format_note', f.get('height', 'unknown')),
-                    "format_id": f.get('format_id'),  # This is the REAL ID you need
-                    "filesize_mb": round(filesize / (1024 * 1024), 2) if filesize else "N/A",
-                    "ext": f.get('ext', 'mp4')
-                })
-
-        # Add a separate option for downloading audio only
-        best_audio = next((f for f in sorted(info.get('formats', []), key=lambda x: x.get('abr') or 0, reverse=True) if f.get('acodec') != 'none'), None)
-        if best_audio:
-            filesize = best_audio.get('filesize') or best_audio.get('filesize_approx')
-            if not filesize:
-                duration, abr = info.get('duration'), best_audio.get('abr')
-                if duration and abr:
-                    filesize = int((abr * 1000 / 8) * duration)
-            
-            processed_formats.append({
-                "quality": "audio_mp3",
-                "format_id": best_audio.get('format_id'), # The ID for the best audio
-                "filesize_mb": round(filesize / (1024 * 1024), 2) if filesize else "N/A",
-                "ext": "mp3"
-            })
 
-        logger.info(f"SUCCESS! Got info for '{url}'.")
-        
-        return {
-            "title": info.get("title", "No Title Found"),
-            "thumbnail_url": info.get("thumbnail"),
-            "description": info.get("description"),
-            "formats": processed_formats
+def filesize_mb(f: dict, bitrate_key: str, bytes_per_kbps):
+    """
+    Reported size of a format in MB, else estimated from its bitrate (kbps) using
+    bytes_per_kbps, which get_universal_media_info computes once from the duration.
+    """
+    filesize = f.get('filesize') or f.get('filesize_approx')
+    if not filesize:
+        bitrate = f.get(bitrate_key)
+        if bytes_per_kbps and bitrate:
+            filesize = int(bitrate * bytes_per_kbps)
+    return round(filesize / (1024 * 1024), 2) if filesize else "N/A"
+
+
+def size_sort_key(entry: dict):
+    """Numeric filesize_mb of a format entry, with "N/A" ranked below any known size."""
+    size = entry["filesize_mb"]
+    return -1 if size == "N/A" else size
+
+
+def get_universal_media_info(info: dict):
+    """
+    Universal media info extractor that gets all available formats with their real format_id.
+    """
+    duration = info.get('duration')
+    bytes_per_kbps = duration * 125 if duration else None  # 1000 / 8 bytes per kbit/s, times seconds
+    # (height, ext, has_audio) -> entry, keeps yt-dlp order; formats without a height stay keyed by format_id
+    processed_formats = {}
+    best_audio, best_abr = None, -1
+
+    # Single pass over all available formats from yt-dlp
+    for f in info.get('formats', ()):
+        # Track the best audio stream as we go instead of sorting the whole list
+        if f.get('acodec') != 'none':
+            abr = f.get('abr') or 0
+            if abr > best_abr:
+                best_audio, best_abr = f, abr
+
+        # Add every available video format to the list
+        if f.get('vcodec') == 'none':
+            continue
+
+        entry = {
+            "quality": f.get('format_note', f.get('height', 'unknown')),
+            "format_id": f.get('format_id'),  # This is the REAL ID you need
+            "filesize_mb": filesize_mb(f, 'tbr', bytes_per_kbps),
+            "ext": f.get('ext', 'mp4')
         }
 
+        # Many platforms list several near-identical renditions per height (bitrate ladders,
+        # DASH variants); keep only the largest one for each height, container and audio
+        # presence, so a bigger video-only stream never hides the muxed one users can play.
+        has_audio = f.get('acodec') != 'none'
+        key = (f['height'], entry["ext"], has_audio) if f.get('height') else f.get('format_id')
+        current = processed_formats.get(key)
+        if current is None or size_sort_key(entry) > size_sort_key(current):
+            processed_formats[key] = entry
+
+    processed_formats = list(processed_formats.values())
+
+    # Add a separate option for downloading audio only
+    if best_audio:
+        processed_formats.append({
+            "quality": "audio_mp3",
+            "format_id": best_audio.get('format_id'), # The ID for the best audio
+            "filesize_mb": filesize_mb(best_audio, 'abr', bytes_per_kbps),
+            "ext": "mp3"
+        })
+
+    return {
+        "title": info.get("title", "No Title Found"),
+        "thumbnail_url": info.get("thumbnail"),
+        "description": info.get("description"),
+        "formats": processed_formats
+    }
+
+
 
 
-def download_media(url: str, format_id: str, is_audio: bool, debug: bool = False):
-    """Universal downloader for any platform supported by yt-dlp."""
+def download_media(url: str, format_id: str, is_audio: bool, info: dict = None):
+    """
+    Universal downloader for any platform supported by yt-dlp.
+    When a pre-extracted info dict is supplied, the extraction step is skipped.
+    """
+    debug = DEBUG_CTX.get()
     ydl_opts = {
         "noplaylist": True,
         # This is the corrected part: Always use the format_id from the user.
         "format": format_id,
         "outtmpl": os.path.join(CACHE_DIR, "%(id)s.%(ext)s"),
-        "cookiefile": "cookies.txt" if os.path.exists("cookies.txt") else None,
-        "logger": YTDLPLogger(),
-        "progress_hooks": [lambda d: logger.debug(d)],
+        "paths": {"temp": WORKER_TEMP_DIR},
+        "extract_flat": "in_playlist",
+        "cookiefile": COOKIES_FILE,
+        "cachedir": YTDLP_CACHE_DIR,
+        "socket_timeout": YTDLP_SOCKET_TIMEOUT,
+        "concurrent_fragment_downloads": FRAGMENT_CONCURRENCY,
+        "http_chunk_size": HTTP_CHUNK_SIZE,
+        "logger": ytdlp_logger,
         "quiet": not debug,
         "verbose": debug,
     }
+    if debug:
+        ydl_opts["progress_hooks"] = [log_progress]
     # The is_audio flag is now only used to decide if we should convert to MP3.
     if is_audio:
         ydl_opts["postprocessors"] = [{
@@ -316,76 +1080,84 @@ def download_media(url: str, format_id: str, is_audio: bool, debug: bool = False
             "preferredcodec": "mp3",
             "preferredquality": "320",
         }]
-    
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        logger.info(f"Starting download for {'audio' if is_audio else 'video'} with options: {ydl_opts}")
-        info = ydl.extract_info(url, download=True)
-        video_id = info.get("id")
-        
-        # When extracting audio with the post-processor, the final extension is always 'mp3'.
-        ext = "mp3" if is_audio else info.get("ext", "mp4")
-        
-        filepath = get_cache_path(video_id, ext)
-        logger.info(f"Download complete. File saved at: {filepath}")
-
-        return {
-            "video_id": video_id,
-            "title": info.get("title"),
-            "thumbnail": info.get("thumbnail"),
-            "filepath": filepath,
-            "ext": ext,
-        }
-
 
+    ydl = get_ydl(("download", format_id, is_audio, debug, COOKIES_FILE, COOKIES_MTIME), ydl_opts)
+    logger.info(f"Starting download for {'audio' if is_audio else 'video'} with options: {ydl_opts}")
+    if info is not None and info.get("_type", "video") == "video":
+        # process_ie_result mutates the dict, so keep the cached copy pristine. Playlist
+        # results lose their entries when cached, so those are always extracted afresh.
+        info = ydl.process_ie_result(copy.deepcopy(info), download=True)
+    else:
+        # Resolve without processing first; with extract_flat a playlist-shaped URL only
+        # lists its entries, and we download just the first one instead of resolving all.
+        info = ydl.extract_info(url, download=False, process=False)
+        if info.get("_type") in PLAYLIST_TYPES:
+            info = next(iter(info.get("entries") or []), None)
+            if info is None:
+                raise ValueError(f"No downloadable entries found for {url}")
+        info = ydl.process_ie_result(info, download=True)
+    video_id = info.get("id")
+
+    # When extracting audio with the post-processor, the final extension is always 'mp3'.
+    ext = "mp3" if is_audio else info.get("ext", "mp4")
+
+    filepath = get_cache_path(video_id, ext)
+    logger.info(f"Download complete. File saved at: {filepath}")
+
+    return {
+        "video_id": video_id,
+        "title": info.get("title"),
+        "thumbnail": info.get("thumbnail"),
+        "filepath": filepath,
+        "ext": ext,
+    }
 
 
+async def handle_download(url: str, format_id: str = "best", is_audio: bool = False, info: dict = None):
+    key = (normalize_url(url), format_id, is_audio)
+    # A recent identical download is reused as long as its file is still in the cache dir.
+    result = download_cache.get(key)
+    if result is not None and await asyncio.to_thread(os.path.exists, result["filepath"]):
+        return result
 
-# --- REPLACE the existing process_queue function with this ---
-async def process_queue():
-    while True:
-        task = await download_queue.get()
-        try:
-            # Use the new universal download_media function
-            info = await asyncio.get_event_loop().run_in_executor(
-                executor,
-                download_media,
-                task["url"],
-                task["format_id"],
-                task["is_audio"],
-                DEBUG
-            )
-            task["future"].set_result(info)
-        except Exception as e:
-            logger.error("Error in process_queue", exc_info=True)
-            if not task["future"].done():
-                task["future"].set_exception(e)
-        finally:
-            download_queue.task_done()
+    # Identical concurrent requests share one download instead of writing the same cache file twice.
+    result = await single_flight(
+        download_inflight,
+        key,
+        lambda: run_download(url, format_id, is_audio, info),
+    )
+    download_cache[key] = result
+    return result
 
 
+async def run_download(url: str, format_id: str, is_audio: bool, info: dict = None):
+    key = normalize_url(url)
+    if info is None:
+        # Reuse the info dict from a preceding /info call instead of extracting again.
+        info = info_cache.get(key)
 
-async def handle_download(url: str, format_id: str = "best", is_audio: bool = False):
-    clean_cache()
-    future = asyncio.Future()
-    
-    await download_queue.put({"url": url, "format_id": format_id, "is_audio": is_audio, "future": future})
-    return await future
+    # Copy the context like asyncio.to_thread does, so DEBUG_CTX reaches the download thread.
+    ctx = contextvars.copy_context()
+    try:
+        result = await asyncio.get_running_loop().run_in_executor(
+            download_executor,
+            functools.partial(ctx.run, download_media, url, format_id, is_audio, info)
+        )
+    except Exception:
+        logger.error("Error in handle_download", exc_info=True)
+        raise
+    return result
 
 
 # ---------------------- API Routes ----------------------
 
 
-# In your main.py, REPLACE the entire @app.get("/") function with this corrected version:
-
-@app.get("/", response_class=HTMLResponse, include_in_schema=False)
-async def landing(request: Request):
-    # This line requires 'quote' to be imported from 'urllib.parse'
-    from urllib.parse import quote
-    
-    # This block dynamically detects the public URL (your worker URL)
-    host = request.headers.get('x-forwarded-host', request.headers.get('host'))
-    scheme = request.headers.get('x-forwarded-proto', 'http')
-    PUBLIC_URL = f"{scheme}://{host}"
+def render_landing_template():
+    """
+    Renders the landing page once at import. Everything except the public URL is
+    constant, so that is left as a literal {PUBLIC_URL} placeholder for landing() to fill.
+    """
+    PUBLIC_URL = "{PUBLIC_URL}"
 
     # Define example URLs for the documentation
     yt_example_url = quote("https://www.youtube.com/watch?v=dQw4w9WgXcQ")
@@ -711,32 +1483,48 @@ async def landing(request: Request):
 </body>
 </html>
 """
-    return HTMLResponse(content=html)
+    return html
+
+
+LANDING_HTML_TEMPLATE = render_landing_template()
+# The page embeds the URL public_url() derives from these headers, so shared caches must key on them.
+LANDING_HEADERS = {
+    "Cache-Control": "public, max-age=600",
+    "Vary": "Host, X-Forwarded-Host, X-Forwarded-Proto",
+}
+
+
+@functools.lru_cache(maxsize=64)
+def render_landing(public_url: str) -> bytes:
+    # Bounded, since the key comes from client-supplied Host headers.
+    return LANDING_HTML_TEMPLATE.replace("{PUBLIC_URL}", public_url).encode()
+
+
+@app.get("/", response_class=HTMLResponse, include_in_schema=False)
+async def landing(PUBLIC_URL: str = Depends(public_url)):
+    return HTMLResponse(content=render_landing(PUBLIC_URL), headers=LANDING_HEADERS)
 
 
 
 #  @app.get("/info") route with this new one.
 @app.get("/info", summary="Get Universal Media Info")
-async def get_info_endpoint(url: str = Query(..., description="The media URL to get information for.")):
+async def get_info_endpoint(url: str = Depends(decoded_url)):
     """
     Fetches video metadata for any supported platform (YouTube, Facebook, etc.).
     """
     try:
         # Use the new universal info extractor
-        info = await asyncio.get_event_loop().run_in_executor(
-            executor,
-            get_universal_media_info, # Call the new function
-            unquote(url),
-            DEBUG
-        )
+        info = get_universal_media_info(await get_cached_info(url))
         return create_response(True, result=info)
+    except HTTPException as e:
+        return create_response(False, message=e.detail, status=e.status_code)
     except Exception as e:
         logger.error(f"/info endpoint error for URL {url}: {e}", exc_info=True)
         return create_response(False, message=str(e), status=500)
 
 
 @app.get("/download/ytmp4fhd")
-async def ytmp4fhd(url: str = Query(...), format_id: str = Query("best")):
+async def ytmp4fhd(url: str = Depends(decoded_url), format_id: str = Query("best")):
     """
     Downloads a YouTube video for a specific format and streams it directly.
     """
@@ -744,60 +1532,54 @@ async def ytmp4fhd(url: str = Query(...), format_id: str = Query("best")):
     try:
         # Use a flexible format string that prioritizes the user's choice
         final_format = f"{format_id}[ext=mp4]/best[ext=mp4]"
-        info = await handle_download(unquote(url), format_id=final_format, is_audio=False)
+        info = await handle_download(url, format_id=final_format, is_audio=False)
         
         filepath = info.get("filepath")
-        title = info.get("title", "youtube_video")
-        safe_filename = "".join(c for c in title if c.isalnum() or c in (' ', '_')).rstrip()[:50] + ".mp4"
+        media_type, extension = MEDIA_TYPES[False]
+        safe_filename = safe_name(info.get("title"), extension, "youtube_video")
 
-        if not filepath or not os.path.exists(filepath):
+        stat_result = await asyncio.to_thread(stat_file, filepath)
+        if stat_result is None:
             raise HTTPException(status_code=404, detail="Downloaded video file not found.")
 
-        return FileResponse(
-            path=filepath,
-            media_type='video/mp4',
-            filename=safe_filename
-        )
+        return media_response(filepath, stat_result, media_type, safe_filename)
     except Exception as e:
         logger.error(f"YouTube video stream failed for URL {url}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Failed to stream YouTube video: {str(e)}")
 
 
 @app.get("/download/ytmp3")
-async def ytmp3(url: str = Query(...)):
+async def ytmp3(url: str = Depends(decoded_url)):
     """
     Downloads YouTube audio and streams it directly as an MP3 file.
     """
     logger.info(f"Received YouTube MP3 stream request for URL: {url}")
     try:
-        info = await handle_download(unquote(url), is_audio=True)
+        info = await handle_download(url, is_audio=True)
         
         filepath = info.get("filepath")
-        title = info.get("title", "youtube_audio")
-        safe_filename = "".join(c for c in title if c.isalnum() or c in (' ', '_')).rstrip()[:50] + ".mp3"
+        media_type, extension = MEDIA_TYPES[True]
+        safe_filename = safe_name(info.get("title"), extension, "youtube_audio")
 
-        if not filepath or not os.path.exists(filepath):
+        stat_result = await asyncio.to_thread(stat_file, filepath)
+        if stat_result is None:
             raise HTTPException(status_code=404, detail="Downloaded audio file not found.")
 
-        return FileResponse(
-            path=filepath,
-            media_type='audio/mpeg',
-            filename=safe_filename
-        )
+        return media_response(filepath, stat_result, media_type, safe_filename)
     except Exception as e:
         logger.error(f"YouTube MP3 stream failed for URL {url}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Failed to stream YouTube audio: {str(e)}")
 
 
 @app.get("/download/facebook", summary="Download Facebook Video")
-async def download_facebook(url: str = Query(...)):
+async def download_facebook(url: str = Depends(decoded_url), PUBLIC_URL: str = Depends(public_url)):
     try:
         format_string = "bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best"
-        info = await handle_download(unquote(url), format_id=format_string, is_audio=False)
+        info = await handle_download(url, format_id=format_string, is_audio=False)
         
         return create_response(True, {
             "type": "video", "title": info.get("title"),
-            "thumbnail": info.get("thumbnail"), "download_url": f"http://{HOST}:{PORT}/cache/{info['video_id']}.{info['ext']}"
+            "thumbnail": info.get("thumbnail"), "download_url": f"{PUBLIC_URL}/cache/{info['video_id']}.{info['ext']}"
         })
     except Exception as e:
         logger.error(f"Facebook download failed for URL {url}: {e}", exc_info=True)
@@ -806,7 +1588,7 @@ async def download_facebook(url: str = Query(...)):
         
 
 @app.get("/download/facebookmp3", summary="Download Facebook Video as MP3")
-async def download_facebook_mp3(url: str = Query(...)):
+async def download_facebook_mp3(url: str = Depends(decoded_url), PUBLIC_URL: str = Depends(public_url)):
     """
     Downloads the audio track from a Facebook video as a 320kbps MP3 file.
     """
@@ -820,7 +1602,7 @@ async def download_facebook_mp3(url: str = Query(...)):
                 "quality": "320kbps",
                 "title": info.get("title"),
                 "thumbnail": info.get("thumbnail"),
-                "download_url": f"http://{HOST}:{PORT}/cache/{info['video_id']}.{info['ext']}",
+                "download_url": f"{PUBLIC_URL}/cache/{info['video_id']}.{info['ext']}",
             },
         )
     except Exception as e:
@@ -828,33 +1610,39 @@ async def download_facebook_mp3(url: str = Query(...)):
         raise HTTPException(status_code=500, detail=f"Failed to extract audio from Facebook URL: {e}")
 
 
+STREAM_DESCRIPTION = (
+    "Pipe the media straight to the client instead of caching it first. Uses the best single "
+    "file that has both video and audio, which can be lower quality than the default merged "
+    "download; fails with 502 when the site only offers separate video and audio streams."
+)
+
+
 @app.get("/download/tiktok", summary="Download TikTok Video As Video")
-async def download_tiktok(url: str = Query(..., description="The URL-encoded TikTok link.")):
+async def download_tiktok(url: str = Depends(decoded_url), stream: bool = Query(False, description=STREAM_DESCRIPTION)):
     """
     Downloads a TikTok video and returns the file directly as a streaming response.
     """
     logger.info(f"Received direct TikTok Video stream request for URL: {url}")
+    if stream:
+        return await stream_response(url, False, "tiktok_video")
     try:
         # We specify a format that works well for Telegram
         format_string = "bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best"
-        info = await handle_download(unquote(url), format_id=format_string, is_audio=False)
+        info = await handle_download(url, format_id=format_string, is_audio=False)
         
         filepath = info.get("filepath")
         
         # Create a clean filename for the user
-        title = info.get("title", "tiktok_video").replace("'", "")
-        safe_filename = "".join(c for c in title if c.isalnum() or c in (' ', '_')).rstrip()[:50] + ".mp4"
+        media_type, extension = MEDIA_TYPES[False]
+        safe_filename = safe_name(info.get("title"), extension, "tiktok_video")
 
-        if not filepath or not os.path.exists(filepath):
+        stat_result = await asyncio.to_thread(stat_file, filepath)
+        if stat_result is None:
             logger.error(f"Downloaded video file could not be found at path: {filepath}")
             raise HTTPException(status_code=404, detail="Downloaded video file not found on server.")
 
         # Return the actual video file as a streaming response
-        return FileResponse(
-            path=filepath,
-            media_type='video/mp4',
-            filename=safe_filename
-        )
+        return media_response(filepath, stat_result, media_type, safe_filename)
 
     except Exception as e:
         logger.error(f"TikTok video direct download failed for URL {url}", exc_info=True)
@@ -864,29 +1652,28 @@ async def download_tiktok(url: str = Query(..., description="The URL-encoded Tik
 
 
 @app.get("/download/tiktokmp3", summary="Download TikTok Video as MP3")
-async def download_tiktok_mp3(url: str = Query(..., description="The URL-encoded TikTok link.")):
+async def download_tiktok_mp3(url: str = Depends(decoded_url), stream: bool = Query(False, description=STREAM_DESCRIPTION)):
 
     logger.info(f"Received direct TikTok MP3 download stream request for URL: {url}")
+    if stream:
+        return await stream_response(url, True, "tiktok_audio")
     try:
         # This function downloads the file and returns its info, including the local filepath
-        info = await handle_download(unquote(url), is_audio=True)
+        info = await handle_download(url, is_audio=True)
         
         filepath = info.get("filepath")
         
         # Create a clean filename for the user
-        title = info.get("title", "tiktok_audio").replace("'", "")
-        safe_filename = "".join(c for c in title if c.isalnum() or c in (' ', '_')).rstrip()[:50] + ".mp3"
+        media_type, extension = MEDIA_TYPES[True]
+        safe_filename = safe_name(info.get("title"), extension, "tiktok_audio")
 
-        if not filepath or not os.path.exists(filepath):
+        stat_result = await asyncio.to_thread(stat_file, filepath)
+        if stat_result is None:
             logger.error(f"Downloaded file could not be found at path: {filepath}")
             raise HTTPException(status_code=404, detail="Downloaded file not found on server.")
 
         # Return the actual file as a streaming response
-        return FileResponse(
-            path=filepath,
-            media_type='audio/mpeg',
-            filename=safe_filename
-        )
+        return media_response(filepath, stat_result, media_type, safe_filename)
 
     except Exception as e:
         logger.error(f"TikTok MP3 direct download failed for URL {url}", exc_info=True)
@@ -899,27 +1686,24 @@ async def download_tiktok_mp3(url: str = Query(..., description="The URL-encoded
 
 # REPLACE the existing /download/instagram route with this one
 @app.get("/download/instagram", summary="Download Instagram Media as Video")
-async def download_instagram(url: str = Query(..., description="The URL of the Instagram post.")):
+async def download_instagram(url: str = Depends(decoded_url)):
     """
     Downloads an Instagram video and returns it as a direct file stream.
     """
     logger.info(f"Received direct Instagram Video stream request for URL: {url}")
     try:
         format_string = "bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best"
-        info = await handle_download(unquote(url), format_id=format_string, is_audio=False)
+        info = await handle_download(url, format_id=format_string, is_audio=False)
         
         filepath = info.get("filepath")
-        title = info.get("title", "instagram_video")
-        safe_filename = "".join(c for c in title if c.isalnum() or c in (' ', '_')).rstrip()[:50] + ".mp4"
+        media_type, extension = MEDIA_TYPES[False]
+        safe_filename = safe_name(info.get("title"), extension, "instagram_video")
 
-        if not filepath or not os.path.exists(filepath):
+        stat_result = await asyncio.to_thread(stat_file, filepath)
+        if stat_result is None:
             raise HTTPException(status_code=404, detail="Downloaded video file not found.")
 
-        return FileResponse(
-            path=filepath,
-            media_type='video/mp4',
-            filename=safe_filename
-        )
+        return media_response(filepath, stat_result, media_type, safe_filename)
     except Exception as e:
         logger.error(f"Instagram video stream failed for URL {url}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Failed to stream Instagram video: {str(e)}")
@@ -927,67 +1711,43 @@ async def download_instagram(url: str = Query(..., description="The URL of the I
 
 # REPLACE the existing /download/instagrammp3 route with this one
 @app.get("/download/instagrammp3", summary="Download Instagram Media as MP3")
-async def download_instagram_mp3(url: str = Query(..., description="The URL of the Instagram post.")):
+async def download_instagram_mp3(url: str = Depends(decoded_url)):
     """
     Downloads audio from an Instagram post and returns it as a direct file stream.
     """
     logger.info(f"Received direct Instagram MP3 stream request for URL: {url}")
     try:
-        info = await handle_download(unquote(url), is_audio=True)
+        info = await handle_download(url, is_audio=True)
         
         filepath = info.get("filepath")
-        title = info.get("title", "instagram_audio")
-        safe_filename = "".join(c for c in title if c.isalnum() or c in (' ', '_')).rstrip()[:50] + ".mp3"
+        media_type, extension = MEDIA_TYPES[True]
+        safe_filename = safe_name(info.get("title"), extension, "instagram_audio")
 
-        if not filepath or not os.path.exists(filepath):
+        stat_result = await asyncio.to_thread(stat_file, filepath)
+        if stat_result is None:
             raise HTTPException(status_code=404, detail="Downloaded audio file not found.")
 
-        return FileResponse(
-            path=filepath,
-            media_type='audio/mpeg',
-            filename=safe_filename
-        )
+        return media_response(filepath, stat_result, media_type, safe_filename)
     except Exception as e:
         logger.error(f"Instagram MP3 stream failed for URL {url}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Failed to stream Instagram audio: {str(e)}")
 
 
 @app.get("/download/xnxx", summary="Get All Info and Download Links for a Single XNXX URL")
-async def download_xnxx(request: Request, url: str = Query(..., description="The direct URL of the XNXX video.")):
-
-    from urllib.parse import quote
+async def download_xnxx(url: str = Depends(decoded_url), API_BASE_URL: str = Depends(public_url)):
     logger.info(f"Received direct info and download link request for XNXX URL: {url}")
     
     try:
         # Step 1: Get all media information for the given URL.
-        media_info = await asyncio.get_event_loop().run_in_executor(
-            executor,
-            get_universal_media_info,
-            unquote(url),
-            DEBUG
-        )
+        media_info = get_universal_media_info(await get_cached_info(url))
 
-        host = request.headers.get('x-forwarded-host', request.headers.get('host', f"{HOST}:{PORT}"))
-        scheme = request.headers.get('x-forwarded-proto', 'http')
-        API_BASE_URL = f"{scheme}://{host}"
-        
-        enhanced_formats = []
-        page_url_encoded = quote(unquote(url))
+        # Step 2: Add a direct download link to every format; only the format_id varies.
+        link_prefix = f"{API_BASE_URL}/download?url={quote(url)}&format_id="
+        enhanced_formats = [
+            {**f, 'download_url': link_prefix + quote(str(f.get('format_id', '')))}
+            for f in media_info.get("formats", [])
+        ]
 
-        for f in media_info.get("formats", []):
-            format_id_encoded = quote(str(f.get('format_id', '')))
-
-            download_link = (
-                f"{API_BASE_URL}/download?"
-                f"url={page_url_encoded}"
-                f"&format_id={format_id_encoded}"
-            )
-            
-            # Add the direct download link to the format information.
-            new_format = f.copy()
-            new_format['download_url'] = download_link
-            enhanced_formats.append(new_format)
-        
         # Step 3: Combine the title, thumbnail, and the list of formats into one final result.
         final_result = {
             "title": media_info.get("title"),
@@ -998,6 +1758,9 @@ async def download_xnxx(request: Request, url: str = Query(..., description="The
         # Return everything in a single, successful response.
         return create_response(True, result=final_result)
 
+    except HTTPException:
+        # Keep get_cached_info's 503 (breaker open) and 504 (timeout) instead of turning them into 500s.
+        raise
     except Exception as e:
         logger.error(f"Failed to process direct XNXX URL {url}: {e}", exc_info=True)
         # Provide a helpful error message if something goes wrong.
@@ -1006,7 +1769,7 @@ async def download_xnxx(request: Request, url: str = Query(..., description="The
 
 @app.get("/download", summary="Universal Media Downloader by Specific Format ID")
 async def download_specific_format(
-    url: str = Query(..., description="The URL of the media to download"),
+    url: str = Depends(decoded_url),
     format_id: str = Query(..., description="The specific format_id obtained from the /info endpoint"),
     audio_only: bool = Query(False, description="Set to true if the format is audio")
 ):
@@ -1017,31 +1780,20 @@ async def download_specific_format(
     logger.info(f"Received universal download request for URL: {url} with format_id: {format_id}")
     try:
         # Use the existing handle_download queue to download the file
-        info = await handle_download(unquote(url), format_id=format_id, is_audio=audio_only)
+        info = await handle_download(url, format_id=format_id, is_audio=audio_only)
         
         filepath = info.get("filepath")
         
-        if not filepath or not os.path.exists(filepath):
+        stat_result = await asyncio.to_thread(stat_file, filepath)
+        if stat_result is None:
             logger.error(f"Downloaded file could not be found at path: {filepath}")
             raise HTTPException(status_code=404, detail="Downloaded media file not found on server.")
 
-        # Determine the correct media type and create a safe filename
-        title = info.get("title", "downloaded_media")
-        if audio_only:
-            media_type = "audio/mpeg"
-            extension = ".mp3"
-        else:
-            media_type = "video/mp4"
-            extension = ".mp4"
-            
-        safe_filename = "".join(c for c in title if c.isalnum() or c in (' ', '_')).rstrip()[:50] + extension
+        media_type, extension = MEDIA_TYPES[audio_only]
+        safe_filename = safe_name(info.get("title"), extension, "downloaded_media")
 
         # Return the actual file as a streaming response
-        return FileResponse(
-            path=filepath,
-            media_type=media_type,
-            filename=safe_filename
-        )
+        return media_response(filepath, stat_result, media_type, safe_filename)
 
     except Exception as e:
         logger.error(f"Universal download failed for URL {url} with format_id {format_id}", exc_info=True)
@@ -1052,24 +1804,56 @@ async def download_specific_format(
 
 
 
-@app.get("/cache/{filename}")
-async def serve_cache(filename: str):
-    filepath = os.path.join(CACHE_DIR, filename)
-    if not os.path.exists(filepath):
-        raise HTTPException(status_code=404, detail="File not found")
-    return FileResponse(filepath, media_type="application/octet-stream", filename=filename)
+async def require_admin(x_admin_token: str = Header(None)):
+    """Dependency for state-changing admin endpoints: they only exist when ADMIN_TOKEN is set."""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not x_admin_token or not secrets.compare_digest(x_admin_token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
 
 
+@app.delete("/info/cache", summary="Clear Cached Metadata", dependencies=[Depends(require_admin)])
+async def clear_info_cache():
+    """
+    Drops all cached info, search and download results so the next request for a URL
+    goes back to the source. Files already in the cache dir are left to periodic_clean.
+    Requires the X-Admin-Token header to match ADMIN_TOKEN.
+    """
+    cleared = len(info_cache) + len(search_cache) + len(download_cache)
+    info_cache.clear()
+    search_cache.clear()
+    download_cache.clear()
+    logger.info(f"Cleared {cleared} cached metadata entries")
+    return create_response(True, result={"cleared": cleared})
+
+
+def read_from(path: str, start: int):
+    """Yields a file's bytes from offset start in MEDIA_CHUNK_SIZE blocks."""
+    with open(path, "rb") as f:
+        f.seek(start)
+        while chunk := f.read(MEDIA_CHUNK_SIZE):
+            yield chunk
+
 
 @app.get("/logs")
-async def get_logs():
-    if not os.path.exists(LOG_FILE):
+async def get_logs(tail: int = Query(None, ge=1, description="Only return the last N bytes of the log.")):
+    await asyncio.to_thread(file_buffer.flush)
+    stat_result = await asyncio.to_thread(stat_file, LOG_FILE)
+    if stat_result is None:
         raise HTTPException(status_code=404, detail="Log file not found")
-    return FileResponse(LOG_FILE, media_type="text/plain", filename=LOG_FILE)
+    if tail is None:
+        return FileResponse(LOG_FILE, media_type="text/plain", filename=LOG_FILE, stat_result=stat_result)
+    # Sync generator: Starlette iterates it on the thread pool, so reads stay off the loop.
+    start = max(0, stat_result.st_size - tail)
+    return StreamingResponse(read_from(LOG_FILE, start), media_type="text/plain")
 
 
 # ---------------------- yt-dlp Updater ----------------------
-def update_yt_dlp(channel: str):
+def update_yt_dlp(channel: str) -> int:
+    """
+    Upgrades yt-dlp from the given channel and returns pip's exit code.
+    CLI only: run it from cron or a separate container, never from the serving process.
+    """
     if channel == "nightly":
         url = "https://github.com/yt-dlp/yt-dlp-nightly-builds/releases/latest/download/yt-dlp.tar.gz"
     elif channel == "master":
@@ -1077,9 +1861,29 @@ def update_yt_dlp(channel: str):
     else:
         url = "yt-dlp"
 
-    subprocess.run([sys.executable, "-m", "pip", "install", "--upgrade", "--force-reinstall", url])
-    logger.info(f"yt-dlp updated to {channel} build. Restarting...")
-    os.execv(sys.executable, [sys.executable] + sys.argv)
+    # Nightly/master builds share a version number across commits, so they must be reinstalled.
+    force = channel != "stable"
+    install_args = ["install", "--upgrade", "--no-deps"]
+    uv = shutil.which("uv")
+    if uv:
+        # uv resolves and installs far faster than pip and needs no second interpreter start-up.
+        cmd = [uv, "pip", *install_args, "--python", sys.executable]
+        if force:
+            cmd.append("--reinstall-package=yt-dlp")
+    else:
+        cmd = [sys.executable, "-m", "pip", *install_args]
+        if force:
+            cmd.append("--force-reinstall")
+    cmd.append(url)
+
+    # pip has no supported in-process API, so it always runs as a subprocess.
+    returncode = subprocess.run(cmd).returncode
+
+    if returncode == 0:
+        logger.info(f"yt-dlp updated to {channel} build. Restart the server to pick it up.")
+    else:
+        logger.error(f"yt-dlp update to {channel} build failed with exit code {returncode}")
+    return returncode
 
 
 # ---------------------- CLI ----------------------
@@ -1087,14 +1891,24 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog="python main.py")
     parser.add_argument("--u", "--update", dest="update",
                         choices=["n", "s", "m", "nightly", "stable", "master"],
-                        help="Update yt-dlp build")
+                        help="Update yt-dlp build and exit")
+    parser.add_argument("--reload-pid", type=int, dest="reload_pid",
+                        help="After a successful update, send SIGHUP to this uvicorn master process "
+                             "so it restarts its workers one at a time. Only valid with "
+                             "WEB_CONCURRENCY > 1: a single-process uvicorn (as in the Dockerfile) "
+                             "has no master and exits on SIGHUP, so restart that one yourself")
     parser.add_argument("--v", "--version", action="store_true", dest="version",
                         help="Show yt-dlp version")
     parser.add_argument("--d", "--debug", action="store_true", dest="debug",
                         help="Enable verbose debug logging")
     parsed = parser.parse_args()
+    if parsed.reload_pid and WEB_CONCURRENCY <= 1:
+        parser.error("--reload-pid needs WEB_CONCURRENCY > 1; a single uvicorn process would shut down on SIGHUP")
 
-    DEBUG = bool(parsed.debug)
+    if parsed.debug:
+        # Worker processes re-import this module, so pass the flag through the environment.
+        os.environ["DEBUG"] = "1"
+        DEBUG = True
 
     if parsed.version:
         from yt_dlp import version as ytdlp_version
@@ -1103,7 +1917,24 @@ if __name__ == "__main__":
 
     if parsed.update:
         channel_map = {"n": "nightly", "s": "stable", "m": "master"}
-        update_yt_dlp(channel_map.get(parsed.update, parsed.update))
-
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=PORT)
+        exit_code = update_yt_dlp(channel_map.get(parsed.update, parsed.update))
+        if exit_code == 0 and parsed.reload_pid:
+            # The master keeps the socket open while each worker drains and re-imports yt-dlp.
+            os.kill(parsed.reload_pid, signal.SIGHUP)
+            logger.info(f"Sent SIGHUP to uvicorn master {parsed.reload_pid} to restart its workers")
+        log_listener.stop()
+        sys.exit(exit_code)
+
+    # uvicorn.run("main:app") would import this file a second time as "main" (and spawned
+    # workers a third, as "__mp_main__"), repeating the logging, executor and client setup.
+    # Replace this process with the uvicorn CLI so the module is only ever loaded as "main".
+    # Each worker process keeps its own info cache and in-flight maps; more than one needs LOG_FILE=.
+    log_listener.stop()
+    file_buffer.flush()
+    os.execv(sys.executable, [
+        sys.executable, "-m", "uvicorn", "main:app",
+        "--app-dir", os.path.dirname(os.path.abspath(__file__)),
+        "--host", "0.0.0.0", "--port", str(PORT),
+        "--loop", "uvloop", "--http", "httptools",
+        "--workers", str(WEB_CONCURRENCY),
+    ])